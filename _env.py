@@ -0,0 +1,11 @@
+from functools import lru_cache
+
+import dotenv
+
+
+@lru_cache(maxsize=1)
+def load(path):
+    # Parsing the environment file is only done
+    # once regardless of how many modules request it
+    dotenv.load_dotenv(path)
+    return True
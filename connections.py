@@ -1,13 +1,29 @@
+import os
+
 import redis
-from emailing_server import logger
+from emailing_server.log import logger
+
+REDIS_HOST = os.getenv('REDIS_HOST', 'localhost')
+
+REDIS_PORT = int(os.getenv('REDIS_PORT', 5679))
+
+REDIS_POOL = int(os.getenv('REDIS_POOL', 32))
+
+_POOL = redis.ConnectionPool(
+    host=REDIS_HOST,
+    port=REDIS_PORT,
+    max_connections=REDIS_POOL,
+    socket_keepalive=True
+)
 
 
 def redis_connection():
-    instance = redis.Redis('localhost', 5679, '')
+    instance = redis.Redis(connection_pool=_POOL)
     try:
         instance.ping()
-    except:
+    except redis.exceptions.ConnectionError:
         logger.debug('Connection to Redis failed')
         return False
     else:
         return instance
+
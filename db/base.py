@@ -1,16 +1,19 @@
 import dataclasses
 import os
-from collections import OrderedDict
+from contextlib import contextmanager
 from dataclasses import dataclass
 from functools import cached_property
 
 import psycopg2
+import psycopg2.sql
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
 
 # https://www.postgresql.org/docs/current/datatype.html
 # https://www.digitalocean.com/community/tutorials/how-to-use-a-postgresql-database-in-a-flask-application
 
 
-@dataclass
+@dataclass(frozen=True, eq=True, slots=True)
 class Field:
     name: str
     max_length: int = 100
@@ -19,47 +22,48 @@ class Field:
     integer: bool = False
     decimal: bool = False
     boolean: bool = False
-    default: str | bool | list | int = None
+    # Defaults can be lists which cannot be
+    # hashed so they are left out of the hash
+    default: str | bool | list | int = dataclasses.field(default=None, hash=False)
     primary_key: bool = False
 
     def __str__(self):
         return self.name
 
-    def __hash__(self):
-        return hash((self.name, self.primary_key))
-
-    def __eq__(self, value):
-        return self.name == value
+    def matches(self, name):
+        return self.name == name
 
     def as_sql(self):
         return [self.name]
 
 
-@dataclass
+@dataclass(frozen=True, eq=True, slots=True)
 class CharField(Field):
     var_char: bool = True
 
 
-@dataclass
+@dataclass(frozen=True, eq=True, slots=True)
 class IntegerField(Field):
     integer: int = True
 
 
-@dataclass
+@dataclass(frozen=True, eq=True, slots=True)
 class BooleanField(Field):
     boolean: bool = True
 
 
 class BaseRelationship:
+    __slots__ = ()
+
     is_relationship = True
 
 
-@dataclass
+@dataclass(slots=True)
 class ForeignKey(BaseRelationship):
     model: type
 
 
-@dataclass
+@dataclass(slots=True)
 class ManyToMany(BaseRelationship):
     model: type
 
@@ -68,8 +72,10 @@ class SQL:
     select = 'SELECT {fields} FROM {name}'
     alter_table = "ALTER TABLE {name}"
     drop_table = 'DROP TABLE IF EXISTS {name}'
+    count = 'SELECT COUNT(*) FROM ({sql}) AS {name}'
     create_table = 'CREATE TABLE IF NOT EXISTS {name} ({fields})'
     insert_into_table = 'INSERT INTO {name} ({fields}) VALUES ({values})'
+    bulk_insert_into_table = 'INSERT INTO {name} ({fields}) VALUES %s'
 
     def __init__(self):
         self._cached_sql = None
@@ -89,25 +95,25 @@ class SQL:
     def get_sql_maps(self, fields):
         pass
 
-    def join_partials(self, sql_maps, is_create=False):
-        partials = []
-        formatted_sql_maps = []
-
-        for item in sql_maps:
-            if isinstance(item, str):
-                formatted_sql_maps.append([item])
-            else:
-                formatted_sql_maps.append(item)
+    def join_partials(self, sql_maps):
+        # Composed items are used as is while lists
+        # start with the name of the column which is
+        # quoted followed by its arguments
+        composable_type = psycopg2.sql.Composable
 
-        for sql_map in formatted_sql_maps:
-            if is_create:
-                if 'id' in sql_map:
+        def partials():
+            for item in sql_maps:
+                if isinstance(item, composable_type):
+                    yield item
                     continue
 
-            partial = ' '.join(sql_map)
-            partials.append(partial)
+                name, *arguments = item
+                partial = psycopg2.sql.Identifier(name)
+                if arguments:
+                    partial = partial + psycopg2.sql.SQL(f" {' '.join(arguments)}")
+                yield partial
 
-        return ', '.join(partials)
+        return psycopg2.sql.SQL(', ').join(partials())
 
 
 class OneToOneRelationship(SQL):
@@ -123,11 +129,11 @@ class OneToOneRelationship(SQL):
     def add_constraints(self, sql_map, foreign_key=True):
         if foreign_key:
             foreign_key_sql = "{field_name} INTEGER REFERENCES {reference_table}({field_name})"
-            foreign_key_sql = foreign_key_sql.format(
-                field_name=self.reference_field, 
-                reference_table=self.reference_table
+            foreign_key_sql = psycopg2.sql.SQL(foreign_key_sql).format(
+                field_name=psycopg2.sql.Identifier(self.reference_field),
+                reference_table=psycopg2.sql.Identifier(self.reference_table)
             )
-            sql_map.append([foreign_key_sql])
+            sql_map.append(foreign_key_sql)
 
         # if foreign_key:
         #     constraint_map.append('ADD CONSTRAINT {constraint_name}')
@@ -143,29 +149,22 @@ class OneToOneRelationship(SQL):
 
 class Table(SQL):
     alter_table = "ALTER TABLE {name}"
-    table_exists = "SELECT EXISTS (SELECT FROM pg_tables WHERE schemaname='public' AND tablename={name})"
+    table_exists = "SELECT EXISTS (SELECT FROM pg_tables WHERE schemaname='public' AND tablename=%s)"
 
     def __init__(self, name):
         super().__init__()
         self.table_name = name
         self._cached_fields = []
-        self.field_map = OrderedDict()
+        self.field_map = {}
         self.relationships = []
-        self.relationship_field_map = OrderedDict()
+        self.relationship_field_map = {}
+        self._insert_columns = []
+        self._insert_sql = None
+        self._bulk_insert_sql = None
 
     def __repr__(self):
         return f'<Table [{self.table_name}]>'
 
-    @property
-    def fields_count(self):
-        # Do not include the ID field in the
-        # overall field count
-        return len(self._cached_fields) - 1
-
-    @cached_property
-    def field_names(self):
-        return list(map(lambda x: x.name, self._cached_fields))
-
     @property
     def has_relationships(self):
         return len(self.relationship_field_map.keys()) > 0
@@ -221,81 +220,174 @@ class Table(SQL):
                 sql_maps.append(self.prepare_field(field))
         return sql_maps
 
+    def prepare_insert_sql(self):
+        # The insert statements never change once the
+        # table is created so they are composed once
+        # with the identifiers already quoted, as for
+        # the other statements
+        columns = [name for name in self.field_map if name != 'id']
+        for relationship in self.relationship_field_map.values():
+            columns.append(relationship.reference_field)
+        self._insert_columns = columns
+        name = psycopg2.sql.Identifier(self.table_name)
+        fields = psycopg2.sql.SQL(', ').join(
+            map(psycopg2.sql.Identifier, columns)
+        )
+        values = psycopg2.sql.SQL(', ').join(
+            psycopg2.sql.Placeholder() * len(columns)
+        )
+
+        self._insert_sql = psycopg2.sql.SQL(self.insert_into_table).format(
+            name=name,
+            fields=fields,
+            values=values
+        )
+        self._bulk_insert_sql = psycopg2.sql.SQL(self.bulk_insert_into_table).format(
+            name=name,
+            fields=fields
+        )
+
     def new_table_sql(self, fields=[]):
         self.check_fields(fields)
         sql_maps = self.get_sql_maps(fields)
+        self.prepare_insert_sql()
 
-        sql_arguments = {'name': self.table_name}
+        sql_arguments = {'name': psycopg2.sql.Identifier(self.table_name)}
         if self.has_relationships:
             for key, relationship in self.relationship_field_map.items():
                 relationship.add_constraints(sql_maps)
 
         arguments = self.join_partials(sql_maps)
         sql_arguments.update({'fields': arguments})
-        partial_sql = self.create_table.format(**sql_arguments)
-        return self.finalize_sql(partial_sql)
+        return psycopg2.sql.SQL(self.create_table).format(**sql_arguments)
+
+    def get_insert_values(self, item):
+        # Orders the values of the mapping by
+        # the columns of the insert statement
+        unknown = [name for name in item if name not in self._insert_columns]
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+
+        missing = [name for name in self._insert_columns if name not in item]
+        if missing:
+            raise ValueError(f"Missing fields: {', '.join(missing)}")
+
+        return tuple(item[name] for name in self._insert_columns)
+
+    def check_insert_columns(self):
+        if not self._insert_columns:
+            raise ValueError('Table has no columns to insert into')
 
     def insert_in_table_sql(self, values):
-        if len(values) != self.fields_count:
+        self.check_insert_columns()
+        if len(values) != len(self._insert_columns):
             raise ValueError('There are more values than fields')
 
-        fields = self.join_partials(self.field_names, is_create=True)
+        # The values are passed as parameters to
+        # the cursor which takes care of quoting them
+        return self._insert_sql, tuple(values)
 
-        values = list(map(lambda x: self.quote(x), values))
-        values = self.join_partials(values)
-        partial_sql = self.insert_into_table.format(
-            name=self.table_name,
-            fields=fields,
-            values=values
-        )
-        return self.finalize_sql(partial_sql)
+    def bulk_insert_in_table_sql(self, rows):
+        self.check_insert_columns()
+        rows = [tuple(values) for values in rows]
+        for values in rows:
+            if len(values) != len(self._insert_columns):
+                raise ValueError('There are more values than fields')
+
+        return self._bulk_insert_sql, rows
 
     def table_exists_sql(self):
-        sql = self.table_exists.format(name=self.quote(self.table_name))
-        return self.finalize_sql(sql)
+        # The name is passed as a parameter to the
+        # cursor which takes care of quoting it
+        return self.finalize_sql(self.table_exists), (self.table_name,)
 
     def select_from_table_sql(self, fields=None):
         if fields is None:
-            fields = '*'
-        sql = self.select.format(fields=fields, name=self.table_name)
-        return self.finalize_sql(sql)
+            fields = psycopg2.sql.SQL('*')
+        else:
+            if isinstance(fields, str):
+                fields = [fields]
+            fields = psycopg2.sql.SQL(', ').join(
+                map(psycopg2.sql.Identifier, fields)
+            )
+        return psycopg2.sql.SQL(self.select).format(
+            fields=fields,
+            name=psycopg2.sql.Identifier(self.table_name)
+        )
+
+    def count_from_table_sql(self, sql=None):
+        # Wrap the query in a subquery so that the
+        # count reflects the rows it returns
+        if sql is None:
+            sql = self.select_from_table_sql()
+        return psycopg2.sql.SQL(self.count).format(
+            sql=sql,
+            name=psycopg2.sql.Identifier(f'{self.table_name}_count')
+        )
 
 
 class Database:
     def __init__(self):
         self.connection = None
         # self.base_tables = ['campaigns', 'emails']
-        self.tables = OrderedDict()
+        self.tables = {}
 
     @cached_property
-    def get_connection(self):
-        return psycopg2.connect(
+    def pool(self):
+        # The pool is only created when a first query
+        # is executed in order to avoid connecting to
+        # the database on import
+        return ThreadedConnectionPool(
+            int(os.getenv('DB_POOL_MIN_CONNECTIONS', 1)),
+            int(os.getenv('DB_POOL_MAX_CONNECTIONS', 16)),
             host='localhost',
             database='emailing_server',
             user=os.getenv('DB_USERNAME', 'emailing_agent'),
             password=os.getenv('DB_PASSWORD', 'touparet')
         )
 
-    @cached_property
-    def cursor(self):
-        connection = self.get_connection
-        return connection, connection.cursor()
-
-    def _execute_cursor(self, sql):
-        connection, cursor = self.cursor
+    @contextmanager
+    def _conn(self):
+        connection = self.pool.getconn()
         try:
-            cursor.execute(sql)
+            yield connection
             connection.commit()
-        except Exception as e:
+        except:
             connection.rollback()
+            raise
         finally:
-            return cursor
-        # else:
-        #     connection.close()
+            self.pool.putconn(connection)
+
+    def _execute_cursor(self, sql, params=None):
+        with self._conn() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(sql, params)
+                if cursor.description is None:
+                    return None
+                return cursor.fetchall()
+
+    def _stream_cursor(self, sql, name, itersize=100, params=None):
+        # Uses a server side cursor so that the rows
+        # are fetched from the database in chunks of
+        # "itersize" instead of all at once
+        with self._conn() as connection:
+            with connection.cursor(name=name) as cursor:
+                cursor.itersize = itersize
+                cursor.execute(sql, params)
+                yield from cursor
+
+    def _execute_values(self, sql, rows, page_size=1000):
+        # Sends the rows in batches of "page_size"
+        # in order to reduce the number of round
+        # trips to the database
+        with self._conn() as connection:
+            with connection.cursor() as cursor:
+                execute_values(cursor, sql, rows, page_size=page_size)
 
     def _table_exists(self, name):
         table = Table(name)
-        return self._execute_cursor(table.table_exists_sql())
+        sql, params = table.table_exists_sql()
+        return self._execute_cursor(sql, params)
 
     def _create_table(self, name, fields):
         instance = Table(name)
@@ -316,8 +408,17 @@ class Database:
         except:
             raise ValueError('Table does not exist')
 
-        sql = table.insert_in_table_sql(values)
-        self._execute_cursor(sql)
+        sql, params = table.insert_in_table_sql(values)
+        self._execute_cursor(sql, params)
+
+    def bulk_insert_into_table(self, name, rows):
+        try:
+            table = self.tables[name]
+        except:
+            raise ValueError('Table does not exist')
+
+        sql, rows = table.bulk_insert_in_table_sql(rows)
+        self._execute_values(sql, rows)
 
 
 database = Database()
@@ -334,53 +435,96 @@ class ModelIterable:
         self.chunks = chunks
 
     def __iter__(self):
-        pass
+        model = self.queryset._model
+        sql = self.queryset._sql
+        if sql is None:
+            sql = model.get_table.select_from_table_sql()
+
+        yield from model._connection._stream_cursor(
+            sql,
+            f'{model.model_name}_cur',
+            itersize=self.chunks
+        )
 
 
 class QuerySet:
     iterable_class = ModelIterable
 
     def __init__(self, model, sql=None, query=None):
-        self._cache = []
+        # None means that the rows were not
+        # fetched yet from the database
+        self._cache = None
         self._model = model
-        # self._sql = sql
+        self._sql = sql
         self._query = query or Query(self)
 
     def __str__(self):
         self.populate_cache()
         return f'<{self.__class__.__name__} {self._cache}>'
 
+    def __iter__(self):
+        if self._cache is not None:
+            yield from self._cache
+            return
+
+        # The rows are cached while they are streamed
+        # so that iterating again does not query the
+        # database another time
+        cache = []
+        for row in self.iterable_class(self):
+            cache.append(row)
+            yield row
+        self._cache = cache
+
     def populate_cache(self):
-        if not self._cache:
-            self._cache = list(self._model._cursor)
+        if self._cache is None:
+            self._cache = list(self.iterable_class(self))
 
     def count(self):
-        self.populate_cache()
-        return len(self._cache)
+        if self._cache is not None:
+            return len(self._cache)
+
+        # Count the rows on the database instead
+        # of fetching all of them
+        sql = self._model.get_table.count_from_table_sql(self._sql)
+        result = self._model._connection._execute_cursor(sql)
+        return result[0][0]
 
 
 class BaseModel:
     queryset_class = QuerySet
 
     def __init__(self, name, fields):
-        self.fields = fields
         self.model_name = str(name).lower()
         self.verbose_model_name = self.model_name.title()
         self._default_manager = None
         self._connection = database
-        self._cursor = None
 
-        if 'id' not in fields:
-            fields.insert(0, Field('id', primary_key=True))
+        # Store a copy of the fields so that the list
+        # passed by the caller is never modified
+        has_id = any(
+            isinstance(field, Field) and field.matches('id')
+            for field in fields
+        )
+        if has_id:
+            self.fields = tuple(fields)
+        else:
+            self.fields = (Field('id', primary_key=True),) + tuple(fields)
 
-        self._connection._create_table(name, fields)
+        self._connection._create_table(self.model_name, self.fields)
 
     def __repr__(self):
         return f'<{self.verbose_model_name}>'
 
-    @property
+    @cached_property
     def get_table(self):
-        return Table(self.model_name)
+        # Reuse the table that was built when the
+        # model was created so that its fields do
+        # not need to be computed again
+        try:
+            return self._connection.tables[self.model_name]
+        except KeyError:
+            raise ValueError('Table does not exist')
 
     async def acreate(self, **kwargs):
         pass
@@ -394,13 +538,18 @@ class BaseModel:
     def create(self, **kwargs):
         self._connection.insert_into_table(
             self.model_name,
-            list(kwargs.values())
+            self.get_table.get_insert_values(kwargs)
+        )
+
+    def bulk_create(self, items):
+        self._connection.bulk_insert_into_table(
+            self.model_name,
+            [self.get_table.get_insert_values(item) for item in items]
         )
 
     def all(self):
         sql = self.get_table.select_from_table_sql()
-        self._cursor = self._connection._execute_cursor(sql)
-        return self.queryset_class(self)
+        return self.queryset_class(self, sql=sql)
 
     def get(self, *args, **kwargs):
         pass
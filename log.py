@@ -0,0 +1,128 @@
+import atexit
+import io
+import logging
+import queue
+import sys
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+# Size of the buffer used to coalesce the
+# records before writing them to stderr
+BUFFER_SIZE = 65536
+
+# Interval in seconds after which the buffered
+# records are written regardless of their level
+FLUSH_INTERVAL = 0.2
+
+
+def buffered_stderr():
+    try:
+        # closefd is disabled so that the buffered
+        # stream never closes the actual stderr
+        return io.open(
+            sys.stderr.fileno(),
+            mode='w',
+            buffering=BUFFER_SIZE,
+            encoding=sys.stderr.encoding,
+            errors='backslashreplace',
+            closefd=False
+        )
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return sys.stderr
+
+
+# Only records at WARNING level and above
+# flush the stream. The other records are
+# flushed periodically by the listener
+class BufferedStreamHandler(logging.StreamHandler):
+    def __init__(self, stream=None):
+        super().__init__(stream)
+        # Whether records were written since
+        # the stream was last flushed
+        self.dirty = False
+
+    def flush(self):
+        pass
+
+    def force_flush(self):
+        super().flush()
+        self.dirty = False
+
+    def emit(self, record):
+        super().emit(record)
+        self.dirty = True
+        if record.levelno >= logging.WARNING:
+            self.force_flush()
+
+
+class BufferedQueueListener(QueueListener):
+    def __init__(self, queue, *handlers, flush_interval=FLUSH_INTERVAL, **kwargs):
+        super().__init__(queue, *handlers, **kwargs)
+        self.flush_interval = flush_interval
+        self._last_flush = time.monotonic()
+
+    @property
+    def dirty(self):
+        return any(getattr(handler, 'dirty', False) for handler in self.handlers)
+
+    def flush(self):
+        for handler in self.handlers:
+            getattr(handler, 'force_flush', handler.flush)()
+        self._last_flush = time.monotonic()
+
+    def dequeue(self, block):
+        # Flush the handlers from the listener's
+        # thread when the queue stays idle or when
+        # the interval has elapsed. When nothing is
+        # waiting to be flushed, block until the
+        # next record arrives
+        while True:
+            if not self.dirty:
+                return self.queue.get(block)
+
+            remaining = self.flush_interval - (time.monotonic() - self._last_flush)
+            if remaining <= 0:
+                self.flush()
+                continue
+
+            try:
+                return self.queue.get(block, timeout=remaining)
+            except queue.Empty:
+                self.flush()
+
+    def stop(self):
+        super().stop()
+        self.flush()
+
+
+logger = logging.getLogger('Emailing')
+
+# Only configure the logger once in order
+# to avoid attaching the handler multiple
+# times when the module gets re-imported
+if not logger.handlers:
+    logger.setLevel(logging.DEBUG)
+    # The records are only handled by the listener
+    # and never passed on to the root logger
+    logger.propagate = False
+
+    # Records are pushed to a queue and written
+    # by the listener's thread so that writing to
+    # stderr does not block the event loop
+    log_queue = queue.SimpleQueue()
+    logger.addHandler(QueueHandler(log_queue))
+
+    handler = BufferedStreamHandler(buffered_stderr())
+    formatter = logging.Formatter(
+        '%(asctime)s - %(name)s - %(levelname)s: %(message)s',
+        datefmt='%Y-%m-%d %H:%M'
+    )
+    handler.setFormatter(formatter)
+
+    listener = BufferedQueueListener(
+        log_queue,
+        handler,
+        respect_handler_level=True
+    )
+    listener.start()
+    atexit.register(listener.stop)
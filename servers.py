@@ -1,32 +1,46 @@
 import asyncio
 import dataclasses
 import datetime
+import itertools
 import json
 import logging
 from asyncio.tasks import sleep
 from dataclasses import dataclass, field
 
-import pytz
-import redis
-
-from emailing_server import logger
-from emailing_server.connections import redis_connection
+from emailing_server.log import logger
 
 # POST http://api.example.com -> flask (email) -> redis
 # WHILE server <-> redis -> IF campaigns -> Send email
 
+# Maximum number of items that can be waiting in
+# the queues before the producers get suspended
+QUEUE_MAX_SIZE = 256
+
+_UTC = datetime.timezone.utc
 
-redis_conn = redis_connection()
+_now = datetime.datetime.now
 
 
 class ModelMixin:
+    # Holds the instances built from the raw data.
+    # It is a slot rather than a dataclass field so
+    # that it is not part of the dataclass fields
+    __slots__ = ('_cache',)
+
     def transform_date(self, d):
         if d is None:
             return None
-        return datetime.datetime.strptime(d, '%Y-%m-%d %H:%M:%S.%f')
+        # The dates are stored as "%Y-%m-%d %H:%M:%S.%f"
+        # which fromisoformat parses directly in C. They
+        # are in UTC so that they can be compared with
+        # the dates returned by get_date
+        date = datetime.datetime.fromisoformat(d)
+        if date.tzinfo is None:
+            date = date.replace(tzinfo=_UTC)
+        return date
 
 
-@dataclass
+@dataclass(slots=True)
 class Step:
     id: int
     value: int
@@ -37,7 +51,7 @@ class Step:
         return hash((self.id, self.send_date))
 
 
-@dataclass
+@dataclass(slots=True)
 class Email(ModelMixin):
     id: int
     email: str
@@ -49,13 +63,15 @@ class Email(ModelMixin):
 
     @property
     def get_steps(self):
-        instances = []
-        for step in self.steps:
-            instances.append(Step(**step))
-        return instances
+        # The instances are only built once and
+        # stored in a slot since there is no __dict__
+        cache = getattr(self, '_cache', None)
+        if cache is None:
+            cache = self._cache = tuple(Step(**step) for step in self.steps)
+        return cache
 
 
-@dataclass
+@dataclass(slots=True)
 class Campaign(ModelMixin):
     id: int
     reference: str
@@ -72,10 +88,12 @@ class Campaign(ModelMixin):
 
     @property
     def get_emails(self):
-        instances = []
-        for email in self.emails:
-            instances.append(Email(**email))
-        return instances
+        # The instances are only built once and
+        # stored in a slot since there is no __dict__
+        cache = getattr(self, '_cache', None)
+        if cache is None:
+            cache = self._cache = tuple(Email(**email) for email in self.emails)
+        return cache
 
     @property
     def get_start_date(self):
@@ -86,80 +104,139 @@ class Campaign(ModelMixin):
         return self.transform_date(self.next_date)
 
 
+def email_key(campaign, email):
+    return campaign.id, email.id, email.current_step
+
+
 def get_date():
-    return datetime.datetime.now(tz=pytz.UTC)
+    return _now(_UTC)
 
 
 async def main():
     logger.debug('Starting server')
     start_date = get_date()
 
-    campaign_queue = asyncio.Queue()
-    emails_queue = asyncio.Queue()
+    loop = asyncio.get_running_loop()
+
+    campaign_queue = asyncio.Queue(maxsize=QUEUE_MAX_SIZE)
+    # The emails are ordered by the time at which
+    # they should be sent. The counter breaks ties
+    # between emails scheduled at the same time.
+    # Emails that are not due yet wait in this
+    # queue so it is left unbounded in order to
+    # not block the campaigns from being read
+    emails_queue = asyncio.PriorityQueue()
+    emails_counter = itertools.count()
+    # The campaigns are read again on every tick
+    # so keep track of the emails that were already
+    # scheduled for their current step. Only the
+    # emails from the last read are kept
+    scheduled_emails = set()
+    # Wakes up the sender when a new email is
+    # scheduled while it waits for the next one
+    email_scheduled = asyncio.Event()
 
     send_emails_every = 2
     next_sending_date = None
 
+    def load_campaigns():
+        with open('redis.json', mode='rb') as f:
+            return json.loads(f.read())
+
     async def read_campaigns():
-        with open('redis.json', encoding='utf-8') as f:
-            data = json.load(f)
-            for campaign in data:
-                instance = Campaign(**campaign)
-                if instance.active:
-                    # Put the campaign in the Queue if the
-                    # start date 
-                    if instance.get_start_date > get_date():
-                        await campaign_queue.put(instance)
-                await asyncio.sleep(1)
+        # Read the file in a thread so that the
+        # event loop is not blocked by the I/O
+        data = await asyncio.to_thread(load_campaigns)
+        current_emails = set()
+        for campaign in data:
+            instance = Campaign(**campaign)
+            if instance.active:
+                # Put the campaign in the Queue if the
+                # start date 
+                if instance.get_start_date > get_date():
+                    current_emails.update(
+                        email_key(instance, email)
+                        for email in instance.get_emails
+                    )
+                    await campaign_queue.put(instance)
+
+        # Forget the emails whose campaign was removed
+        # or whose step changed since the last read
+        scheduled_emails.intersection_update(current_emails)
 
     async def get_emails():
-        while not campaign_queue.empty():
+        while True:
             campaign = await campaign_queue.get()
+            wait_time = campaign.minutes * 60
             for email in campaign.get_emails:
-                await emails_queue.put((campaign.minutes, email))
+                has_current_step = any(
+                    step.value == email.current_step
+                    for step in email.get_steps
+                )
+                if not has_current_step:
+                    continue
+
+                key = email_key(campaign, email)
+                if key in scheduled_emails:
+                    continue
+                scheduled_emails.add(key)
+
+                send_time = loop.time() + wait_time
+                await emails_queue.put((send_time, next(emails_counter), email))
+                email_scheduled.set()
             logger.debug('Getting emails')
-            await asyncio.sleep(1)
+            campaign_queue.task_done()
 
     async def send_emails():
         # TODO: Emails should be sent every x minutes
+        debug = logger.debug
+        is_enabled_for = logger.isEnabledFor
+        while True:
+            item = await emails_queue.get()
+            send_time, _, email = item
+
+            delay = send_time - loop.time()
+            if delay > 0:
+                # The earliest email is not due yet so put
+                # it back and sleep until it is or until
+                # an email is scheduled in the meantime
+                emails_queue.put_nowait(item)
+                emails_queue.task_done()
+                email_scheduled.clear()
+                try:
+                    await asyncio.wait_for(email_scheduled.wait(), delay)
+                except TimeoutError:
+                    pass
+                continue
+
+            if is_enabled_for(logging.DEBUG):
+                debug('Sending email: %s', email)
+            emails_queue.task_done()
+
+    async with asyncio.TaskGroup() as group:
+        # The consumers are only created once and
+        # wait for the queues to receive items
+        group.create_task(get_emails())
+        group.create_task(send_emails())
+
         next_date = None
-        while not emails_queue.empty():
+        while True:
             current_date = get_date()
-            wait_time, email = await emails_queue.get()
-            for step in email.get_steps:
-                if not step.value == email.current_step:
-                    continue
+            # if next_date is not None:
+            #     logger.debug(current_date > next_date)
+            if next_date is None:
+                next_date = get_date() + datetime.timedelta(minutes=1)
+
+            if current_date > next_date:
+                next_date = get_date() + datetime.timedelta(minutes=1)
+
+            # Check if there are campaigns
+            # in the Redis database and
+            # include them in the Queue
+            await read_campaigns()
 
-                if next_date is None:
-                    next_date = current_date + \
-                        datetime.timedelta(minutes=wait_time)
-
-                if current_date >= next_date:
-                    next_date = None
-                    logger.debug(f'Sending email: {email}')
-            await asyncio.sleep(10)
-
-    next_date = None
-    while True:
-        current_date = get_date()
-        # if next_date is not None:
-        #     logger.debug(current_date > next_date)
-        if next_date is None:
-            next_date = get_date() + datetime.timedelta(minutes=1)
-
-        if current_date > next_date:
-            next_date = get_date() + datetime.timedelta(minutes=1)
-
-        # Check if there are campaigns
-        # in the Redis database and
-        # include them in the Queue
-        await read_campaigns()
-        # When the "campaign_queue" has campaigns,
-        # get all the emails and send if necessary
-        await asyncio.gather(get_emails(), send_emails())
-
-        logger.debug('Sleeping 5 seconds')
-        await asyncio.sleep(5)
+            logger.debug('Sleeping 5 seconds')
+            await asyncio.sleep(5)
 
 
 if __name__ == '__main__':